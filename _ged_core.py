@@ -0,0 +1,474 @@
+"""GEDCOM-jäsennys, paikkojen geokoodaus ja karttanimaatio.
+
+Erillinen moduuli, jotta Streamlit ei suorita näitä määrittelyjä uudelleen
+jokaisella ajokerralla: moduuli tuodaan kerran per prosessi.
+"""
+import streamlit as st
+import pandas as pd
+import numpy as np
+import re
+import io
+import codecs
+import hashlib
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+from pathlib import Path
+
+_YEAR_RE = re.compile(r'(\d{4})')
+_WHITESPACE_RE = re.compile(r'\s+')
+_COMMA_RE = re.compile(r'\s*,\s*')
+
+# Kasvata, jos parse_gedcom-tuloksen sarakkeet tai tyypit muuttuvat
+_PARSE_CACHE_VERSION = 3
+
+# Karttanimaatio: pisteet yhdistetään 1/20 asteen (~5 km) ruutuihin
+_GRID_PER_DEGREE = 20
+_HOVER_MAX_NAMES = 10
+# Pitkillä aikaväleillä kehysväliä kasvatetaan, jotta kehyksiä on enintään näin monta
+_MAX_FRAMES = 60
+
+# Välimuistit säilyvät levyllä istuntojen ja uudelleenkäynnistysten yli
+# käyttäjän omassa hakemistossa (ei yhteisessä väliaikaishakemistossa:
+# jäsennetyt tiedostot sisältävät nimiä ja syntymäaikoja)
+_CACHE_DIR = Path.home() / ".cache" / "geo"
+_GEO_CACHE_PATH = _CACHE_DIR / "geocache.sqlite"
+# Jäsennystulokset poistetaan, kun niitä ei ole kirjoitettu 30 päivään
+_PARSE_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Nominatim-haun yritykset ohimenevissä virheissä (429, aikakatkaisu)
+_GEOCODE_TRIES = 3
+# Pidempää Retry-After-odotusta ei jäädä odottamaan (sekuntia)
+_GEOCODE_MAX_WAIT = 30
+
+def _format_name(name_value):
+    """Muuttaa NAME-arvon "Etunimi /Sukunimi/" muotoon "Etunimi Sukunimi"."""
+    name_parts = name_value.split("/")
+    first = name_parts[0].strip()
+    last = name_parts[1].strip() if len(name_parts) > 1 else ""
+    return f"{first} {last}".strip()
+
+def _append_person(names, dates, places, raw_name, birth_date, birth_place):
+    """Lisää henkilön sarakelistoihin, jos syntymäaika ja -paikka löytyivät."""
+    # Nimi muotoillaan vasta tässä: ilman syntymätietoja jääviä ei käsitellä
+    if birth_place and birth_date:
+        names.append(_format_name(raw_name))
+        dates.append(birth_date)
+        places.append(birth_place)
+
+def _detect_encoding(file_content):
+    """Päättelee koodauksen BOMista ja tiedoston alusta."""
+    if file_content[:3] == b'\xef\xbb\xbf':
+        return 'utf-8-sig'
+
+    # Latin-1-tiedosto paljastuu yleensä jo alussa, jolloin koko tiedostoa
+    # ei pureta turhaan ensin UTF-8:na.
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(file_content[:4096], final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+def _iter_gedcom_lines(file_content, encoding):
+    """Purkaa tavut paloittain ja palauttaa rivit yksi kerrallaan."""
+    # BytesIO jakaa tavupuskurin, joten koko tiedostoa ei pureta yhdeksi
+    # merkkijonoksi eikä rivilistaksi; muistissa on vain käsiteltävä pala.
+    return io.TextIOWrapper(io.BytesIO(file_content), encoding=encoding, newline=None)
+
+def _content_digest(file_content):
+    """Nopea sisältötiiviste (BLAKE2b) välimuistien avaimeksi."""
+    return hashlib.blake2b(file_content, digest_size=16).digest()
+
+def parse_gedcom(file_content):
+    """Lukee GEDCOM-tiedoston ja etsii syntymätiedot."""
+    # Sisältö tiivistetään kerran; sama avain käy sekä Streamlitin että
+    # levyvälimuistin avaimeksi.
+    return _parse_gedcom_cached(_content_digest(file_content).hex(), file_content)
+
+# Alaviivalla alkavaa parametria Streamlit ei tiivistä: välimuistin
+# avain on pelkkä 32 merkin tiiviste.
+@st.cache_data
+def _parse_gedcom_cached(key, _file_content):
+    """Jäsentää tiedoston; tulos tallennetaan levylle sisällön tiivisteellä."""
+    # Sama tiedosto ei jäsenny uudelleen myöskään uudessa istunnossa.
+    cache_path = _CACHE_DIR / f"ged_v{_PARSE_CACHE_VERSION}_{key}.parquet"
+    if cache_path.exists():
+        try:
+            return pd.read_parquet(cache_path)
+        except Exception:
+            pass
+
+    df = _scan_gedcom(_file_content)
+    if not df.empty:
+        try:
+            _cache_dir()
+            df.to_parquet(cache_path, compression='zstd')
+            cache_path.chmod(0o600)
+            _prune_parse_cache()
+        except Exception:
+            pass
+    return df
+
+def _cache_dir():
+    """Luo välimuistihakemiston vain käyttäjän luettavaksi."""
+    _CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return _CACHE_DIR
+
+def _prune_parse_cache():
+    """Poistaa vanhentuneet jäsennystulokset (myös vanhat versiot)."""
+    cutoff = time.time() - _PARSE_CACHE_MAX_AGE
+    for path in _CACHE_DIR.glob("ged_v*.parquet"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+def _collect_people(lines):
+    """Kerää henkilöiden nimet, syntymäajat ja -paikat GEDCOM-riveistä."""
+    # Sarakkeet kerätään erillisiin listoihin (ei sanakirjaa per henkilö).
+    # Sama paikannimi tallennetaan yhtenä merkkijono-oliona.
+    names, dates, places = [], [], []
+    place_intern = {}
+
+    # Yksi läpikäynti riveittäin ("taso tagi arvo"). Seurataan, ollaanko
+    # INDI-tietueessa ja sen BIRT/CHR-tapahtumassa tai arvottomassa
+    # NAME-rivissä (nimi GIVN/SURN-alariveillä). Muut tietueet ja
+    # henkilön loput rivit, kun nimi, aika ja paikka on jo saatu,
+    # ohitetaan jäsentämättä seuraavaan 0-tason riviin asti.
+    in_indi = False
+    in_birth = False
+    in_name = False
+    skip_record = True
+    raw_name = ""
+    given = ""
+    surname = ""
+    birth_date = ""
+    birth_place = ""
+
+    for line in lines:
+        # Tyhjät rivit ohitetaan tässä, ei erillistä siivousta
+        line = line.strip()
+        if not line or (skip_record and line[0] != "0"):
+            continue
+        # Tagi ja arvo luetaan vain haaroissa, jotka niitä tarvitsevat
+        parts = line.split(" ", 2)
+        level = parts[0]
+
+        if level == "0":
+            if in_indi:
+                _append_person(names, dates, places, raw_name, birth_date, birth_place)
+            in_indi = len(parts) == 3 and parts[2] == "INDI"
+            in_birth = False
+            in_name = False
+            skip_record = not in_indi
+            raw_name = ""
+            given = ""
+            surname = ""
+            birth_date = ""
+            birth_place = ""
+        elif len(parts) < 2:
+            continue
+        elif level == "1":
+            tag = parts[1]
+            in_birth = tag == "BIRT" or tag == "CHR"
+            # Arvoton "1 NAME": nimi kootaan alariveistä "2 GIVN" ja "2 SURN"
+            in_name = tag == "NAME" and not raw_name and len(parts) == 2
+            # Tyhjä nimi ("//") ei kelpaa, seuraava NAME-rivi voi korvata sen
+            if tag == "NAME" and not raw_name and len(parts) == 3 and parts[2].strip(" /"):
+                raw_name = parts[2]
+                skip_record = bool(birth_date and birth_place)
+        elif level == "2" and in_name and len(parts) == 3:
+            tag = parts[1]
+            if tag == "GIVN":
+                given = parts[2]
+            elif tag == "SURN":
+                surname = parts[2]
+            if given or surname:
+                raw_name = f"{given} /{surname}/"
+        elif level == "2" and in_birth and len(parts) == 3:
+            tag = parts[1]
+            if tag == "DATE":
+                birth_date = birth_date or parts[2]
+            elif tag == "PLAC":
+                birth_place = birth_place or place_intern.setdefault(parts[2], parts[2])
+            if birth_date and birth_place:
+                in_birth = False
+                skip_record = bool(raw_name)
+
+    if in_indi:
+        _append_person(names, dates, places, raw_name, birth_date, birth_place)
+
+    return names, dates, places
+
+def _scan_gedcom(file_content):
+    """Jäsentää GEDCOM-tavut henkilötaulukoksi."""
+    names, dates, places = [], [], []
+
+    try:
+        try:
+            lines = _iter_gedcom_lines(file_content, _detect_encoding(file_content))
+            names, dates, places = _collect_people(lines)
+        except UnicodeDecodeError:
+            # Virheellinen UTF-8 vasta tiedoston alun jälkeen: luetaan Latin-1:nä
+            names, dates, places = _collect_people(_iter_gedcom_lines(file_content, 'latin-1'))
+    except Exception as e:
+        st.error(f"Virhe tiedoston luvussa: {e}")
+    
+    # Tyypit annetaan heti: tekstit Arrow-merkkijonoina, ja samat pitäjät
+    # toistuvat satoja kertoja, joten Paikka tallentuu kategoriana kerran.
+    df = pd.DataFrame({
+        "Nimi": pd.array(names, dtype="string[pyarrow]"),
+        "Syntymäaika": pd.array(dates, dtype="string[pyarrow]"),
+        "Paikka": pd.Categorical(places),
+    })
+    if df.empty:
+        return df
+
+    # Vuosi poimitaan koko sarakkeesta kerralla; rivit ilman vuotta pois
+    years = df['Syntymäaika'].str.extract(_YEAR_RE.pattern, expand=False)
+    df.insert(2, 'Vuosi', pd.to_numeric(years, errors='coerce').astype('Int16'))
+    return df.dropna(subset=['Vuosi']).astype({'Vuosi': 'int16'}).reset_index(drop=True)
+
+def _geo_cache_connect():
+    _cache_dir()
+    conn = sqlite3.connect(_GEO_CACHE_PATH, timeout=10)
+    conn.execute("CREATE TABLE IF NOT EXISTS geo(place TEXT PRIMARY KEY, lat REAL, lon REAL, ts INTEGER)")
+    return conn
+
+def _load_cached_coords(places):
+    """Hakee levyvälimuistista jo tunnettujen paikkojen koordinaatit."""
+    places = list(places)
+    coords = {}
+    try:
+        with closing(_geo_cache_connect()) as conn:
+            # SQLiten parametrimäärä on rajattu, joten haetaan paloissa
+            for i in range(0, len(places), 500):
+                chunk = places[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = conn.execute(f"SELECT place, lat, lon FROM geo WHERE place IN ({marks})", chunk)
+                for place, lat, lon in rows:
+                    coords[place] = (lat, lon)
+    except (sqlite3.Error, OSError):
+        pass
+    return coords
+
+def _store_cached_coords(coords):
+    """Tallentaa uudet koordinaatit levyvälimuistiin."""
+    try:
+        with closing(_geo_cache_connect()) as conn, conn:
+            now = int(time.time())
+            conn.executemany(
+                "INSERT OR REPLACE INTO geo(place, lat, lon, ts) VALUES (?, ?, ?, ?)",
+                [(place, lat, lon, now) for place, (lat, lon) in coords.items()],
+            )
+    except (sqlite3.Error, OSError):
+        pass
+
+@st.cache_resource
+def _memory_coords():
+    """Prosessin yhteinen paikka -> (lat, lon) -sanakirja levyvälimuistin päällä."""
+    return {}
+
+def _normalize_place(place):
+    """Yhtenäistää paikan nimen hakuavaimeksi: "Helsinki , Finland" -> "helsinki"."""
+    key = _COMMA_RE.sub(', ', _WHITESPACE_RE.sub(' ', place)).strip().casefold()
+    return key.removesuffix(', finland').removesuffix(', suomi').strip()
+
+@st.cache_resource
+def _get_geocoder():
+    """Prosessin yhteinen Nominatim-haku: yksi Session ja yksi RateLimiter."""
+    # geopy tuodaan vasta tarvittaessa (nopeampi kylmäkäynnistys)
+    from geopy.adapters import RequestsAdapter
+    from geopy.extra.rate_limiter import RateLimiter
+    from geopy.geocoders import Nominatim
+
+    # Session säilyttää keep-alive-yhteydet hakujen ja ajokertojen välillä.
+    # Yhteinen RateLimiter pitää kaikki säikeet ja istunnot Nominatimin
+    # tahdissa (RateLimiter on säieturvallinen); säikeet limittävät vain
+    # verkkoviiveen.
+    geolocator = Nominatim(user_agent="family_map_app_v3", adapter_factory=RequestsAdapter)
+    # Uudelleenyritykset hoitaa _lookup_place (max_retries=0 tässä)
+    return RateLimiter(geolocator.geocode, min_delay_seconds=1.1, max_retries=0,
+                       swallow_exceptions=False)
+
+def _lookup_place(geocode, query):
+    """Hakee yhden paikan koordinaatit; (None, None), jos paikkaa ei löydy."""
+    from geopy.exc import GeocoderRateLimited, GeocoderTimedOut
+
+    # Ohimenevät virheet (429, aikakatkaisu) yritetään uudelleen
+    # kasvavalla viiveellä; muut virheet nousevat kutsujalle.
+    for attempt in range(_GEOCODE_TRIES):
+        try:
+            loc = geocode(query)
+            break
+        except (GeocoderRateLimited, GeocoderTimedOut) as e:
+            if attempt == _GEOCODE_TRIES - 1:
+                raise
+            wait = getattr(e, 'retry_after', None) or 2 ** attempt
+            if wait > _GEOCODE_MAX_WAIT:
+                # Paikka jää tältä kerralta pois ja haetaan seuraavalla ajolla
+                raise
+            time.sleep(wait)
+    return (loc.latitude, loc.longitude) if loc else (None, None)
+
+@st.cache_data
+def geocode_dataframe(df):
+    """Hakee koordinaatit."""
+    # Saman paikan kirjoitusasut ("Helsinki", "helsinki ") haetaan kerran.
+    # Avain lasketaan kerran per kategoria ja levitetään riveille koodeilla.
+    places = df['Paikka'].astype('category').cat.remove_unused_categories()
+    place_keys = places.cat.categories.map(_normalize_place)
+    unique_places = place_keys.unique()
+
+    # Haku kerroksittain: prosessin muisti (kaikki istunnot), levy, Nominatim
+    memory = _memory_coords()
+    place_coords = {place: memory[place] for place in unique_places if place in memory}
+    not_in_memory = [place for place in unique_places if place not in place_coords]
+    if not_in_memory:
+        disk_coords = _load_cached_coords(not_in_memory)
+        memory.update(disk_coords)
+        place_coords.update(disk_coords)
+    missing = [place for place in unique_places if place not in place_coords]
+
+    if missing:
+        geocode = _get_geocoder()
+        new_coords = {}
+
+        # Hakulauseet kerralla ennen hakuja: maa lisätään, ellei se jo ole
+        # (pienaakkosin kirjoitetussa) avaimessa
+        keys = pd.Series(missing, dtype=object)
+        queries = keys.where(keys.str.contains('finland|suomi', regex=True), keys + ", Finland")
+
+        # Progress bar
+        my_bar = st.progress(0)
+        total = len(missing)
+        last_ui = 0.0
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                executor.submit(_lookup_place, geocode, query): place
+                for place, query in zip(missing, queries)
+            }
+            for i, future in enumerate(as_completed(futures)):
+                place = futures[future]
+                # Jokainen päivitys on viesti selaimelle: korkeintaan ~2/s
+                now = time.monotonic()
+                if now - last_ui > 0.5 or i == total - 1:
+                    my_bar.progress((i + 1) / total, text=f"Haetaan paikkoja ({i + 1}/{total})")
+                    last_ui = now
+                try:
+                    new_coords[place] = future.result()
+                except Exception:
+                    # Virhettä ei tallenneta levylle, jotta paikka haetaan uudelleen
+                    place_coords[place] = (None, None)
+
+        my_bar.empty()
+
+        _store_cached_coords(new_coords)
+        memory.update(new_coords)
+        place_coords.update(new_coords)
+    
+    # Koordinaatit kategorioittain (K, 2) -taulukkoon, rivit poimitaan
+    # kategoriakoodeilla. Viimeinen NaN-rivi vastaa puuttuvaa paikkaa (-1).
+    coord_arr = np.array(
+        [place_coords.get(key, (None, None)) for key in place_keys] + [(None, None)],
+        dtype=np.float32,  # float32 riittää kartalle (~1 m); None -> NaN
+    )
+    coords = coord_arr[places.cat.codes.to_numpy()]
+    found = ~np.isnan(coords).any(axis=1)
+    df = df.loc[found].assign(lat=coords[found, 0], lon=coords[found, 1])
+
+    return df.reset_index(drop=True)
+
+def create_animation_figure(df, step=5):
+    """Luo kertyvän karttanimaation: kehys näyttää vuoteen mennessä syntyneet."""
+    import plotly.graph_objects as go
+
+    # Kehys k näyttää kunkin ~5 km ruudun (useimmiten yksi pitäjä) yhtenä
+    # pisteenä, jonka koko kertoo ruudussa vuoteen mennessä syntyneet.
+    # Ruutujen sijainnit ja tooltipit lähetetään selaimelle kerran; kehys
+    # vaihtaa vain pisteiden koot (= määrät), nolla piilottaa ruudun.
+    df = df.sort_values('Vuosi', kind='mergesort')
+    birth_years = df['Vuosi'].to_numpy()
+    first, last = int(birth_years[0]), int(birth_years[-1])
+    if -(-(last - first) // step) + 1 > _MAX_FRAMES:
+        step *= -(-(last - first) // (step * (_MAX_FRAMES - 1)))
+    years = np.arange(first, last + step, step)
+    lat = df['lat'].to_numpy()
+    lon = df['lon'].to_numpy()
+
+    people = pd.DataFrame({
+        'cell_lat': np.round(lat * _GRID_PER_DEGREE).astype(np.int32),
+        'cell_lon': np.round(lon * _GRID_PER_DEGREE).astype(np.int32),
+        'label': (df['Nimi'].astype(str) + " (" + df['Syntymäaika'].astype(str) + ")").to_numpy(),
+        'Paikka': df['Paikka'].astype(str).to_numpy(),
+    })
+    cell = people.groupby(['cell_lat', 'cell_lon'], sort=False).ngroup().to_numpy()
+    frame = np.searchsorted(years, birth_years, side='left')
+
+    # Kertymä: syntyneet per (kehys, ruutu), summattuna kehysten yli
+    counts = np.zeros((len(years), cell.max() + 1), dtype=np.int32)
+    np.add.at(counts, (frame, cell), 1)
+    counts = counts.cumsum(axis=0)
+
+    # Piste ruudun kaikkien henkilöiden keskelle
+    per_cell = np.bincount(cell)
+    cell_lat = (np.bincount(cell, weights=lat) / per_cell).astype(np.float32)
+    cell_lon = (np.bincount(cell, weights=lon) / per_cell).astype(np.float32)
+
+    # Tooltip: ruudun eri paikat ja varhaisimmat nimet (henkilöt ovat
+    # syntymävuoden järjestyksessä); määrä luetaan pisteen koosta.
+    people['cell'] = cell
+    by_cell = people.groupby('cell', sort=True)
+    places = by_cell['Paikka'].agg(lambda p: ", ".join(p.unique()))
+    names = by_cell['label'].agg(lambda labels: "<br>".join(labels.iloc[:_HOVER_MAX_NAMES]))
+    names = names + np.where(per_cell > _HOVER_MAX_NAMES, "<br>…", "")
+    customdata = np.column_stack([places.to_numpy(), names.to_numpy()])
+
+    # Pinta-ala kasvaa määrän mukana: suurin ruutu 30 px, pienin näkyvä 6 px
+    trace = go.Scattermapbox(
+        lat=cell_lat, lon=cell_lon, customdata=customdata,
+        mode="markers",
+        hovertemplate="<b>%{customdata[0]}</b> (%{marker.size})<br>%{customdata[1]}<extra></extra>",
+        marker={"color": "#636efa", "size": counts[0], "sizemode": "area",
+                "sizeref": int(counts[-1].max()) / 15 ** 2 / 2, "sizemin": 3},
+        showlegend=False,
+    )
+    frames = [
+        go.Frame(name=str(y), data=[go.Scattermapbox(marker={"size": counts[k]})])
+        for k, y in enumerate(years)
+    ]
+
+    play_args = {"frame": {"duration": 500, "redraw": True}, "fromcurrent": True}
+    pause_args = {"frame": {"duration": 0, "redraw": False}, "mode": "immediate"}
+    step_args = {"frame": {"duration": 0, "redraw": True}, "mode": "immediate"}
+    fig = go.Figure(data=[trace], frames=frames)
+    fig.update_layout(
+        height=700,
+        margin={"l": 0, "r": 0, "t": 0, "b": 0},
+        mapbox={
+            "style": "open-street-map",
+            "zoom": 4.5,
+            "center": {"lat": float(lat.mean()), "lon": float(lon.mean())},
+        },
+        updatemenus=[{
+            "type": "buttons",
+            "direction": "left",
+            "x": 0.1, "y": 0, "xanchor": "right", "yanchor": "top",
+            "buttons": [
+                {"label": "▶", "method": "animate", "args": [None, play_args]},
+                {"label": "❚❚", "method": "animate", "args": [[None], pause_args]},
+            ],
+        }],
+        sliders=[{
+            "x": 0.1, "y": 0, "len": 0.9,
+            "currentvalue": {"prefix": "Animaatiovuosi="},
+            "steps": [
+                {"label": frame.name, "method": "animate", "args": [[frame.name], step_args]}
+                for frame in frames
+            ],
+        }],
+    )
+    return fig